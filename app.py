@@ -1,34 +1,103 @@
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, Response, stream_with_context
+from flask.json.provider import JSONProvider
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import tempfile
+import shutil
 import uuid
 from werkzeug.utils import secure_filename
 import io
 import csv
+import codecs
 import glob
 import logging
 import traceback
+import atexit
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider that serializes with orjson, so jsonify emits bytes directly"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
+# Let a fronting web server (Apache mod_xsendfile, lighttpd) send video files itself
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Decart API endpoint
+DECART_API_URL = "https://api.decart.ai/v1/generate/lucy-pro-v2v"
+
+# Retry transient upstream failures with exponential backoff. POST is included
+# because request bodies are rewindable; read errors are not retried since the
+# upstream may still be generating (and billing for) the original request.
+retry = Retry(
+    total=4,
+    connect=3,
+    read=False,
+    status=3,
+    backoff_factor=1.0,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(['POST']),
+    respect_retry_after_header=True,
+    raise_on_status=False  # Hand back the last response so callers report its status code
+)
+
+# Shared HTTP session so repeated API calls reuse pooled keep-alive connections
+SESSION = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=retry
+)
+SESSION.mount('https://', adapter)
+
+# Max concurrent Decart API calls per CSV batch
+MAX_CSV_WORKERS = 8
+
+# Post-processing that shouldn't hold up the response (cache population and eviction)
+background_executor = ThreadPoolExecutor(max_workers=2)
+atexit.register(background_executor.shutdown)
+
+# Last allocated output number, persisted so allocation doesn't rescan the directory
+OUTPUT_COUNTER_PATH = 'output_videos/.counter'
+output_number_lock = threading.Lock()
+
+# Cache of generated videos keyed by (video hash, prompt hash)
+CACHE_DIR = 'cache'
+CACHE_MAX_BYTES = 5 * 1024 * 1024 * 1024  # 5GB before least recently used entries are evicted
+cache_lock = threading.Lock()
+
 # Allowed video extensions
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm'}
+ALLOWED_SUFFIXES = tuple(f'.{ext}' for ext in ALLOWED_EXTENSIONS)
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return filename.lower().endswith(ALLOWED_SUFFIXES)
 
-def get_next_output_number():
-    """Get the next sequential output number"""
-    os.makedirs('output_videos', exist_ok=True)
+def get_max_output_number():
+    """Get the highest output number already in output_videos"""
     existing_files = glob.glob('output_videos/output_*.mp4')
     if not existing_files:
-        return 1
+        return 0
     
     numbers = []
     for file in existing_files:
@@ -40,7 +109,192 @@ def get_next_output_number():
         except ValueError:
             continue
     
-    return max(numbers) + 1 if numbers else 1
+    return max(numbers) if numbers else 0
+
+def get_next_output_number(count=1):
+    """Reserve the next count sequential output numbers and return the first"""
+    with output_number_lock:
+        os.makedirs('output_videos', exist_ok=True)
+        try:
+            with open(OUTPUT_COUNTER_PATH) as f:
+                last_number = int(f.read())
+        except (FileNotFoundError, ValueError):
+            # No usable counter yet, so scan the directory once to seed it
+            last_number = get_max_output_number()
+        
+        tmp_path = f"{OUTPUT_COUNTER_PATH}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(str(last_number + count))
+        os.replace(tmp_path, OUTPUT_COUNTER_PATH)
+        return last_number + 1
+
+def save_response(response, path):
+    """Stream a response body straight to disk without buffering it in memory"""
+    response.raw.decode_content = True
+    # Download to a side file so an interrupted transfer never leaves a truncated video at path
+    part_path = f"{path}.part"
+    try:
+        with open(part_path, 'wb') as f:
+            shutil.copyfileobj(response.raw, f, length=1024 * 1024)
+        os.replace(part_path, path)
+    except Exception:
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst, falling back to a copy across filesystems"""
+    try:
+        os.link(src, dst)
+    except (FileNotFoundError, FileExistsError):
+        raise
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def hash_stream(stream, copy_to=None):
+    """Get the SHA-256 hex digest of a seekable stream and rewind it, optionally copying it in the same pass"""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+        h.update(chunk)
+        if copy_to is not None:
+            copy_to.write(chunk)
+    stream.seek(0)
+    return h.hexdigest()
+
+def get_cache_path(video_hash, prompt):
+    """Get the cache path for a (video, prompt) pair"""
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, video_hash, f"{prompt_hash}.mp4")
+
+def fetch_from_cache(cache_path, path):
+    """Link a cached video to path, returning False on a cache miss"""
+    try:
+        os.utime(cache_path)  # Mark as recently used
+    except FileNotFoundError:
+        return False
+    link_or_copy(cache_path, path)
+    return True
+
+def add_to_cache(path, cache_path):
+    """Link a generated video into the cache and evict old entries"""
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    try:
+        link_or_copy(path, cache_path)
+    except FileExistsError:
+        return
+    evict_cache()
+
+def evict_cache():
+    """Remove least recently used cache entries until the cache fits CACHE_MAX_BYTES"""
+    with cache_lock:
+        entries = []
+        for path in glob.glob(os.path.join(CACHE_DIR, '*', '*.mp4')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))  # Only succeeds once the video's last entry is gone
+            except OSError:
+                pass
+            total_size -= size
+
+def multipart_video_framing(boundary):
+    """Get the multipart framing that goes before and after the video part"""
+    video_part_header = (
+        f'--{boundary}\r\n'
+        'Content-Disposition: form-data; name="data"; filename="input.mp4"\r\n'
+        'Content-Type: video/mp4\r\n\r\n'
+    ).encode('utf-8')
+    closing_boundary = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return video_part_header, closing_boundary
+
+def multipart_prompt_part(boundary, prompt):
+    """Get the multipart part carrying the prompt"""
+    return (
+        f'--{boundary}\r\n'
+        'Content-Disposition: form-data; name="prompt"\r\n\r\n'
+        f'{prompt}\r\n'
+    ).encode('utf-8')
+
+class MultipartBody:
+    """Seekable multipart/form-data body that concatenates byte strings and open files
+
+    Files are streamed from disk in whatever block size the HTTP client asks for,
+    and the body can be rewound so the request can be retried.
+    """
+    
+    def __init__(self, parts):
+        self.parts = []
+        for part in parts:
+            if isinstance(part, bytes):
+                size = len(part)
+            else:
+                # SpooledTemporaryFile.seek() only returns the offset from Python 3.11
+                part.seek(0, os.SEEK_END)
+                size = part.tell()
+            self.parts.append((part, size))
+        self.length = sum(size for _, size in self.parts)
+        self.position = 0
+    
+    def __len__(self):
+        return self.length
+    
+    def tell(self):
+        return self.position
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = max(0, offset)
+        return self.position
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+        
+        chunks = []
+        while size > 0 and self.position < self.length:
+            # Find the part the current position falls in
+            offset = self.position
+            for part, part_size in self.parts:
+                if offset < part_size:
+                    break
+                offset -= part_size
+            
+            if isinstance(part, bytes):
+                chunk = part[offset:offset + size]
+            else:
+                part.seek(offset)
+                chunk = part.read(min(size, part_size - offset))
+                if not chunk:
+                    break
+            
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        
+        return b''.join(chunks)
+
+def run_in_background(fn, *args):
+    """Run fn off the request thread, logging any failure"""
+    def run():
+        try:
+            fn(*args)
+        except Exception:
+            logger.error(f"Background task {fn.__name__} failed: {traceback.format_exc()}")
+    background_executor.submit(run)
 
 @app.route('/')
 def index():
@@ -70,61 +324,58 @@ def process_video():
         
         # Get form data
         prompt = request.form.get('prompt', '').strip()
-        orientation = request.form.get('orientation', 'landscape')
         
         if not prompt:
             return jsonify({'error': 'Please provide a prompt'}), 400
         
-        # Read video content
-        video_content = video_file.read()
-        
-        # Set dimensions based on orientation
-        dimensions = {"width": 1280, "height": 704} if orientation == "landscape" else {"width": 704, "height": 1280}
-        
         # Check for API key
         api_key = os.getenv('DECART_API_KEY', 'TlI3OYCRoSD2kgqDAAZnmcj4FuuAff0EbdKilUrvMrA')
         if not api_key:
             return jsonify({'error': 'DECART_API_KEY environment variable not set'}), 500
         
-        # Prepare FormData for the new API
-        files = {
-            'data': ('input.mp4', video_content, 'video/mp4')
-        }
-        data = {
-            'prompt': prompt
-        }
-        
-        # Send request to Decart API
-        response = requests.post(
-            "https://api.decart.ai/v1/generate/lucy-pro-v2v",
-            headers={
-                "X-API-KEY": api_key
-            },
-            files=files,
-            data=data,
-            timeout=300  # 5 minutes timeout
-        )
-        
-        if response.status_code != 200:
-            return jsonify({'error': f'API request failed: {response.status_code}'}), 500
-        
         # Generate unique filename for output
         output_filename = f"processed_{uuid.uuid4().hex[:8]}.mp4"
-        
-        # Save the processed video to static folder for preview
         os.makedirs('static/videos', exist_ok=True)
         output_path = f"static/videos/{output_filename}"
         
-        with open(output_path, 'wb') as f:
-            f.write(response.content)
+        # Reuse a previous result for the same video and prompt if we have one
+        cache_path = get_cache_path(hash_stream(video_file.stream), prompt)
+        if not fetch_from_cache(cache_path, output_path):
+            # Prepare FormData for the new API, streaming the video from the upload
+            boundary = uuid.uuid4().hex
+            video_part_header, closing_boundary = multipart_video_framing(boundary)
+            body = MultipartBody([
+                multipart_prompt_part(boundary, prompt),
+                video_part_header,
+                video_file.stream,
+                closing_boundary
+            ])
+            
+            # Send request to Decart API
+            with SESSION.post(
+                DECART_API_URL,
+                headers={
+                    "X-API-KEY": api_key,
+                    "Content-Type": f"multipart/form-data; boundary={boundary}"
+                },
+                data=body,
+                timeout=300,  # 5 minutes timeout
+                stream=True
+            ) as response:
+                if response.status_code != 200:
+                    return jsonify({'error': f'API request failed: {response.status_code}'}), 500
+                
+                # Save the processed video to static folder for preview
+                save_response(response, output_path)
+            
+            run_in_background(add_to_cache, output_path, cache_path)
         
         # Also save to output_videos with sequential number
         output_number = get_next_output_number()
         output_videos_filename = f"output_{output_number:03d}.mp4"
         output_videos_path = f"output_videos/{output_videos_filename}"
         
-        with open(output_videos_path, 'wb') as f:
-            f.write(response.content)
+        link_or_copy(output_path, output_videos_path)
         
         # Return the video URL for preview
         video_url = f"/static/videos/{output_filename}"
@@ -162,87 +413,133 @@ def process_csv():
         if not allowed_file(video_file.filename):
             return jsonify({'error': 'Invalid video file type'}), 400
         
-        # Get orientation
-        orientation = request.form.get('orientation', 'landscape')
-        dimensions = {"width": 1280, "height": 704} if orientation == "landscape" else {"width": 704, "height": 1280}
-        
-        # Read video content
-        video_content = video_file.read()
-        
         # Check for API key
         api_key = os.getenv('DECART_API_KEY', 'TlI3OYCRoSD2kgqDAAZnmcj4FuuAff0EbdKilUrvMrA')
         if not api_key:
             return jsonify({'error': 'DECART_API_KEY environment variable not set'}), 500
         
-        # Read CSV file
-        csv_content = csv_file.read().decode('utf-8')
-        csv_reader = csv.reader(csv_content.splitlines())
+        # Read CSV file, decoding it line by line from the upload stream
+        csv_reader = csv.reader(codecs.getreader('utf-8')(csv_file.stream))
+        prompts = [row[0].strip() for row in csv_reader if row and row[0].strip()]  # Skip empty rows
         
-        results = []
+        os.makedirs('static/videos', exist_ok=True)
         
-        for row_index, row in enumerate(csv_reader):
-            if not row or not row[0].strip():  # Skip empty rows
-                continue
-                
-            prompt = row[0].strip()
+        # Save the video to disk once so every prompt can read it from there,
+        # hashing it for the cache key in the same pass
+        fd, video_path = tempfile.mkstemp(suffix='.mp4')
+        try:
+            with os.fdopen(fd, 'wb') as video_copy:
+                video_hash = hash_stream(video_file.stream, copy_to=video_copy)
             
+            # Multipart framing around the video is the same for every prompt, so build it once
+            boundary = uuid.uuid4().hex
+            video_part_header, closing_boundary = multipart_video_framing(boundary)
+            
+            # Reserve one output number per prompt up front so numbering follows CSV order
+            first_output_number = get_next_output_number(len(prompts)) if prompts else 0
+        except Exception:
+            os.remove(video_path)
+            raise
+        
+        # Rows repeating a prompt share one cache key, so generate it once for all of them
+        rows_by_prompt = {}
+        for index, prompt in enumerate(prompts):
+            rows_by_prompt.setdefault(prompt, []).append(index)
+        
+        def save_output(index, prompt, preview_filename, preview_path):
             try:
-                # Prepare FormData for the new API
-                files = {
-                    'data': ('input.mp4', video_content, 'video/mp4')
+                # Also save to output_videos with sequential number
+                output_number = first_output_number + index
+                output_videos_filename = f"output_{output_number:03d}.mp4"
+                output_videos_path = f"output_videos/{output_videos_filename}"
+                
+                link_or_copy(preview_path, output_videos_path)
+                
+                return {
+                    'prompt': prompt,
+                    'success': True,
+                    'video_url': f"/static/videos/{preview_filename}",
+                    'output_file': output_videos_filename,
+                    'index': index
                 }
-                data = {
-                    'prompt': prompt
+            except Exception as e:
+                return {
+                    'prompt': prompt,
+                    'success': False,
+                    'error': str(e),
+                    'index': index
                 }
+        
+        def process_prompt(prompt, indices):
+            try:
+                preview_filename = f"batch_{uuid.uuid4().hex[:8]}.mp4"
+                preview_path = f"static/videos/{preview_filename}"
                 
-                # Send request to Decart API
-                response = requests.post(
-                    "https://api.decart.ai/v1/generate/lucy-pro-v2v",
-                    headers={
-                        "X-API-KEY": api_key
-                    },
-                    files=files,
-                    data=data,
-                    timeout=300
-                )
-                
-                if response.status_code == 200:
-                    # Save to output_videos with sequential number
-                    output_number = get_next_output_number()
-                    output_videos_filename = f"output_{output_number:03d}.mp4"
-                    output_videos_path = f"output_videos/{output_videos_filename}"
-                    
-                    with open(output_videos_path, 'wb') as f:
-                        f.write(response.content)
-                    
-                    # Also save to static for preview
-                    preview_filename = f"batch_{uuid.uuid4().hex[:8]}.mp4"
-                    preview_path = f"static/videos/{preview_filename}"
-                    
-                    with open(preview_path, 'wb') as f:
-                        f.write(response.content)
-                    
-                    results.append({
-                        'prompt': prompt,
-                        'success': True,
-                        'video_url': f"/static/videos/{preview_filename}",
-                        'output_file': output_videos_filename
-                    })
+                # Reuse a previous result for the same video and prompt if we have one
+                cache_path = get_cache_path(video_hash, prompt)
+                if fetch_from_cache(cache_path, preview_path):
+                    status_code = 200
                 else:
-                    results.append({
-                        'prompt': prompt,
-                        'success': False,
-                        'error': f'API request failed: {response.status_code}'
-                    })
+                    with open(video_path, 'rb') as video_stream:
+                        # Prepare FormData for the new API; only the prompt part is encoded per request
+                        prompt_part = multipart_prompt_part(boundary, prompt)
+                        body = MultipartBody([prompt_part, video_part_header, video_stream, closing_boundary])
+                        
+                        # Send request to Decart API
+                        with SESSION.post(
+                            DECART_API_URL,
+                            headers={
+                                "X-API-KEY": api_key,
+                                "Content-Type": f"multipart/form-data; boundary={boundary}"
+                            },
+                            data=body,
+                            timeout=300,
+                            stream=True
+                        ) as response:
+                            status_code = response.status_code
+                            if status_code == 200:
+                                # Save to static for preview
+                                save_response(response, preview_path)
                     
+                    if status_code == 200:
+                        run_in_background(add_to_cache, preview_path, cache_path)
+                
+                if status_code == 200:
+                    return [save_output(index, prompt, preview_filename, preview_path) for index in indices]
+                
+                error = f'API request failed: {status_code}'
             except Exception as e:
-                results.append({
+                error = str(e)
+            
+            return [
+                {
                     'prompt': prompt,
                     'success': False,
-                    'error': str(e)
-                })
+                    'error': error,
+                    'index': index
+                }
+                for index in indices
+            ]
         
-        return jsonify({'success': True, 'results': results})
+        def generate_results():
+            # Prompts are independent API round-trips, so run them concurrently and
+            # stream each result as an NDJSON line as soon as it finishes
+            if rows_by_prompt:
+                with ThreadPoolExecutor(max_workers=min(MAX_CSV_WORKERS, len(rows_by_prompt))) as executor:
+                    futures = [executor.submit(process_prompt, prompt, indices) for prompt, indices in rows_by_prompt.items()]
+                    for future in as_completed(futures):
+                        for result in future.result():
+                            yield orjson.dumps(result) + b'\n'
+        
+        response = Response(
+            stream_with_context(generate_results()),
+            mimetype='application/x-ndjson',
+            headers={'X-Prompt-Count': str(len(prompts))}
+        )
+        # Runs once the response is closed, even if the client disconnects before
+        # streaming starts; any running workers have finished by then
+        response.call_on_close(lambda: os.remove(video_path))
+        return response
         
     except Exception as e:
         logger.error(f"Error in process_csv: {str(e)}")
@@ -22,10 +22,10 @@ fi
 echo "🔧 מפעיל סביבה וירטואלית..."
 source venv/bin/activate
 
-# Check if requirements are installed
-if ! python -c "import flask" 2>/dev/null; then
+# Install requirements on first run and whenever requirements.txt changes
+if [ ! -f venv/.requirements-installed ] || [ requirements.txt -nt venv/.requirements-installed ]; then
     echo "📦 מתקין תלויות..."
-    pip install -r requirements.txt
+    pip install -r requirements.txt && touch venv/.requirements-installed
     echo "✅ תלויות הותקנו"
 fi
 